@@ -19,4 +19,24 @@ COST_INCREASE_FACTOR = 1.0318 # The factor by which the cost of electricity incr
 DISCOUNT_RATE = 1.0499 # The rate at which future costs are discounted
 INCENTIVES = 0 # Local incentives for solar installations
 AVG_INSTALLED_COST_PER_KW = 6600000 # Average cost of installing a solar system per kW
-AVG_INSTALLATION_FIXED_COST = 2453000 # Average fixed cost of installing a solar system
\ No newline at end of file
+AVG_INSTALLATION_FIXED_COST = 2453000 # Average fixed cost of installing a solar system
+
+# Report pipeline
+PIPELINE_MAX_CONVERSATIONS = 50 # Number of conversations whose stage results are kept in a warm container
+REPORT_IMAGE_DPI = 150 # Resolution of the images embedded in the report
+SUMMARY_IMAGE_DPI = 72 # Resolution of the charts inlined in the summary response
+
+# External data sources
+EXTERNAL_API_TIMEOUT = 10 # Seconds to wait for the Google and NREL APIs
+CIRCUIT_FAILURE_THRESHOLD = 3 # Consecutive failures that open the circuit of an external API
+CIRCUIT_LATENCY_THRESHOLD = 5 # Seconds after which a call to an external API counts as a failure
+CIRCUIT_RESET_TIMEOUT = 30 # Seconds the circuit stays open before trying the external API again
+SITE_CACHE_MAX_ENTRIES = 200 # Number of sites whose external data is kept to serve during outages
+PRODUCTION_CACHE_TTL = 24 * 3600 # Seconds the production of a sub-array is reused without calling NREL
+MAX_PARALLEL_ARRAYS = 4 # Number of sub-arrays whose production is fetched concurrently
+MAX_ARRAYS = MAX_PARALLEL_ARRAYS # Maximum number of sub-arrays of a system, all fetched in a single round
+
+# Memory profiling
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', '').lower() in ('1', 'true') # Record the memory usage of each stage and invocation
+MEMORY_GROWTH_WINDOW = 5 # Consecutive warm invocations checked for memory growth
+MEMORY_GROWTH_THRESHOLD = 5 * 1024 * 1024 # Bytes the RSS must grow over the window to flag a leak
@@ -9,9 +9,18 @@ import os
 import requests
 import json
 import math
+import hashlib
+import shutil
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from solarUtils import *
 from s3Utils import saveDocxInS3, getGetterSignedUrl, getUploaderSignedUrl, getReportKey, getRandomPdfKey, changeMetadata
 from buildReport import fill_word_template, convert_docx_to_pdf_with_api2pdf, convert_docx_to_pdf_with_apyhub
+from pipeline import Pipeline, Stage, StaleResult, PipelineError
+from imageUtils import optimizeImage
+from resilience import CircuitBreaker, StaleWhileRevalidate, DataError
+from memoryProfiler import MemoryProfiler
 import config
 import logging
 
@@ -19,102 +28,299 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Width of each image in the report, in millimeters
+REPORT_IMAGE_WIDTHS = {
+    'imglUbicacion': 45,
+    'imglProduccion': 130,
+    'imglFlujoCostos': 130,
+}
+
+# Circuit breakers of the external data sources and the last data fetched for each site
+google_breaker = CircuitBreaker(
+    'google',
+    failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+    latency_threshold=config.CIRCUIT_LATENCY_THRESHOLD,
+    reset_timeout=config.CIRCUIT_RESET_TIMEOUT)
+nrel_breaker = CircuitBreaker(
+    'nrel',
+    failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+    latency_threshold=config.CIRCUIT_LATENCY_THRESHOLD,
+    reset_timeout=config.CIRCUIT_RESET_TIMEOUT)
+location_image_source = StaleWhileRevalidate(google_breaker, max_entries=config.SITE_CACHE_MAX_ENTRIES)
+location_info_source = StaleWhileRevalidate(google_breaker, max_entries=config.SITE_CACHE_MAX_ENTRIES)
+production_source = StaleWhileRevalidate(
+    nrel_breaker,
+    max_entries=config.SITE_CACHE_MAX_ENTRIES,
+    fresh_for=config.PRODUCTION_CACHE_TTL)
+
+# Executor fetching the production of the sub-arrays concurrently
+production_executor = ThreadPoolExecutor(max_workers=config.MAX_PARALLEL_ARRAYS)
+
+# Memory instrumentation, only when enabled with the MEMORY_PROFILING environment variable
+memory_profiler = MemoryProfiler(
+    growth_window=config.MEMORY_GROWTH_WINDOW,
+    growth_threshold=config.MEMORY_GROWTH_THRESHOLD) if config.MEMORY_PROFILING else None
+
 def formatNumber2Decimals(number):
     return round(number, 2)
 
 def formatNumberToCurrency(number):
     return f"${int(number):,}"
 
-def lambda_handler(event, context):
+def formatArraysValue(arrays, key):
     """
-    Lambda function handler for generating a production report.
+    Returns the value of a sub-array property for the report, joining the values when the arrays differ.
+    """
+    values = [f"{array[key]:g}" for array in arrays]
+    if len(set(values)) == 1:
+        return values[0]
+    return ' / '.join(values)
 
-    Args:
-        event (dict): The event data passed to the Lambda function.
-        context (object): The runtime information of the Lambda function.
+def parseNumber(query_params, name, minimum=None, maximum=None, positive=False, required=True):
+    """
+    Gets a numeric query parameter.
 
     Returns:
-        dict: The response containing the PDF URL of the generated report.
+        float: The value of the parameter, or None if it is not required and missing.
 
     Raises:
-        KeyError: If any required query parameter is missing in the event data.
-        requests.exceptions.RequestException: If there is an error calling the Google API or NREL API.
-        ValueError: If the response from the NREL API is not in the expected format.
-        IOError: If there is an error saving or reading the location image or production image.
-        RuntimeError: If there is an error filling the word template or converting the docx to pdf.
+        ValueError: If the parameter is missing, not a number or out of range, with the message for the response.
+    """
+    if not query_params.get(name):
+        if required:
+            raise ValueError(f"Missing {name}")
+        return None
+    try:
+        value = float(query_params[name])
+    except ValueError:
+        raise ValueError(f"Invalid {name}: must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"Invalid {name}: must be a finite number")
+    if positive and value <= 0:
+        raise ValueError(f"Invalid {name}: must be positive")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"Invalid {name}: must be at least {minimum}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"Invalid {name}: must be at most {maximum}")
+    return value
+
+def parseArrays(query_params, lat, system_capacity):
+    """
+    Gets the sub-arrays of the system from the `arrays` query parameter.
+
+    The parameter is a JSON list of objects with the capacity (kW), tilt, azimuth and losses
+    of each sub-array. Missing tilts default to the optimal tilt of the latitude, azimuths to the
+    equator (180 in the northern hemisphere, 0 in the southern one) and losses to 20. Without the parameter the system is a single array of `system_capacity`.
+
+    Returns:
+        list: The sub-arrays as dictionaries.
 
+    Raises:
+        ValueError: If the parameter is not a list of 1 to MAX_ARRAYS sub-arrays with values
+            in the ranges accepted by PVWatts, with the message for the response.
+    """
+    # Face the equator, at the optimal tilt of the distance to it
+    default_tilt = max(calculateOptimalTilt(abs(lat)), 0)
+    default_azimuth = 180 if lat >= 0 else 0
+    if query_params.get('arrays'):
+        try:
+            raw_arrays = json.loads(query_params['arrays'])
+        except ValueError:
+            raise ValueError('Invalid arrays: not valid JSON')
+    else:
+        raw_arrays = [{'capacity': system_capacity}]
+
+    if not isinstance(raw_arrays, list) or not raw_arrays:
+        raise ValueError('Invalid arrays: must be a non-empty list')
+    if len(raw_arrays) > config.MAX_ARRAYS:
+        raise ValueError(f"Invalid arrays: at most {config.MAX_ARRAYS} arrays are supported")
+
+    arrays = []
+    for raw_array in raw_arrays:
+        if not isinstance(raw_array, dict) or 'capacity' not in raw_array:
+            raise ValueError('Invalid arrays: each array must be an object with a capacity')
+        try:
+            array = {
+                'capacity': float(raw_array['capacity']),
+                'tilt': float(raw_array.get('tilt', default_tilt)),
+                'azimuth': float(raw_array.get('azimuth', default_azimuth)),
+                'losses': float(raw_array.get('losses', 20)),
+            }
+        except (TypeError, ValueError):
+            raise ValueError('Invalid arrays: values must be numbers')
+        if not all(math.isfinite(value) for value in array.values()):
+            raise ValueError('Invalid arrays: values must be finite numbers')
+        # Ranges accepted by PVWatts, out of range values would be rejected by NREL
+        if not 0.05 <= array['capacity'] <= 500000:
+            raise ValueError('Invalid arrays: capacity must be between 0.05 and 500000 kW')
+        if not 0 <= array['tilt'] <= 90:
+            raise ValueError('Invalid arrays: tilt must be between 0 and 90')
+        if not 0 <= array['azimuth'] < 360:
+            raise ValueError('Invalid arrays: azimuth must be at least 0 and less than 360')
+        if not -5 <= array['losses'] <= 99:
+            raise ValueError('Invalid arrays: losses must be between -5 and 99')
+        arrays.append(array)
+    return arrays
+
+def conversationTempDir(conversationId):
     """
+    Returns the temp dir of the memoized files of a conversation.
+    """
+    digest = hashlib.md5(conversationId.encode('utf-8')).hexdigest()
+    return os.path.join(config.TEMP_DIR, 'conversations', digest)
 
-    # Get query parameters
-    lat = event['queryStringParameters']['lat']
-    lon = event['queryStringParameters']['lon']
-    system_capacity = float(event['queryStringParameters']['system_capacity'])
-    avg_daily_consumption = float(event['queryStringParameters']['avgDailyConsumption'])
-    panels_capacity = float(event['queryStringParameters']['panelsCapacity'])
-    userId = event['queryStringParameters']['userId']
-    conversationId = event['queryStringParameters']['conversationId']
+def reportTempPath(conversationId, filename):
+    """
+    Returns a path in the temp dir for a file of the given conversation,
+    so memoized files of different conversations do not overwrite each other.
+    """
+    conversation_dir = conversationTempDir(conversationId)
+    os.makedirs(conversation_dir, exist_ok=True)
+    return os.path.join(conversation_dir, filename)
 
-    costPerKwh = float(event['queryStringParameters']['costPerKwh'])
+def removeConversationFiles(conversationId):
+    """
+    Deletes the temp files of a conversation evicted from the pipeline memo,
+    so the ephemeral storage of a warm container stays bounded.
+    """
+    shutil.rmtree(conversationTempDir(conversationId), ignore_errors=True)
+
+def checkedRequest(request, error_message):
+    """
+    Makes a request to an external API for a site data source.
 
+    Timeouts, connection errors and 5xx responses are raised as they are, so they count as
+    failures of the circuit breaker. 4xx responses are raised as DataError, as they are caused
+    by the request and say nothing about the health of the API.
+
+    Returns:
+        requests.Response: The successful response.
+    """
+    try:
+        response = request()
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code < 500:
+            raise DataError(f"{error_message}: {e}")
+        raise
+    return response
+
+def fetchSiteData(source, key, fetch, error_message):
+    """
+    Gets the data of a site through its circuit breaker, falling back to the cached data.
+
+    Returns:
+        tuple: The data and whether it was served from the cache.
+
+    Raises:
+        PipelineError: If the data could not be fetched and there is no cached data.
+    """
+    try:
+        return source.get(key, fetch)
+    except Exception as e:
+        logger.error(f"{error_message}: {e}")
+        raise PipelineError(error_message)
+
+def locationImageStage(lat, lon, conversationId):
     # Get the location image
-    location_image = getLocationImage(lat, lon, config.GOOGLE_API_KEY)
-    if location_image.status_code != 200:
-        return {
-            'statusCode': 500,
-            'body': 'Error calling Google API'
-        }
-    else:
-        location_image = location_image.content
+    def fetch():
+        location_image = checkedRequest(
+            lambda: getLocationImage(lat, lon, config.GOOGLE_API_KEY, timeout=config.EXTERNAL_API_TIMEOUT, raise_errors=True),
+            'Error calling Google API')
+        return location_image.content
+
+    location_image, stale = fetchSiteData(location_image_source, (lat, lon), fetch, 'Error calling Google API')
+
     #save the image to a file
-    location_img = os.path.join(config.TEMP_DIR, 'location_image.png')
+    location_img = reportTempPath(conversationId, 'location_image.png')
     with open(location_img, 'wb') as f:
         f.write(location_image)
+    return StaleResult(location_img) if stale else location_img
 
-
-
+def locationInfoStage(lat, lon):
     # get the location info
-    location_info = getLocationInfo(lat, lon, config.GOOGLE_API_KEY)
-    if location_info.status_code != 200:
-        return {
-            'statusCode': 500,
-            'body': 'Error calling Google API'
-        }
-    else:
-        location_info = location_info.json()
-    
-    address = location_info['results'][0]['formatted_address']
-
-    # Calculate the optimal inclination
-    tilt = calculateOptimalTilt(lat)
+    def fetch():
+        location_info = checkedRequest(
+            lambda: getLocationInfo(lat, lon, config.GOOGLE_API_KEY, timeout=config.EXTERNAL_API_TIMEOUT, raise_errors=True),
+            'Error calling Google API').json()
+        status = location_info.get('status')
+        if status == 'ZERO_RESULTS':
+            # Remote or ocean points have no address, use the coordinates instead
+            return {'address': f"{lat}, {lon}"}
+        if status in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+            raise RuntimeError(f"Google geocoding status {status}")
+        if status != 'OK' or not location_info.get('results'):
+            raise DataError(f"Google geocoding status {status}")
+        return {'address': location_info['results'][0]['formatted_address']}
+
+    location_info, stale = fetchSiteData(location_info_source, (lat, lon), fetch, 'Error calling Google API')
+    return StaleResult(location_info) if stale else location_info
+
+def arrayProduction(lat, lon, array):
     # Call NREL API
-    url = f"https://developer.nrel.gov/api/pvwatts/v8.json?api_key={config.NREL_API_KEY}&lat={lat}&lon={lon}&system_capacity={system_capacity}&azimuth=180&tilt={0}&array_type=1&module_type=1&losses=20"
+    url = f"https://developer.nrel.gov/api/pvwatts/v8.json?api_key={config.NREL_API_KEY}&lat={lat}&lon={lon}&system_capacity={array['capacity']}&azimuth={array['azimuth']}&tilt={array['tilt']}&array_type=1&module_type=1&losses={array['losses']}"
 
-    # Get the response
-    response = requests.get(url)
-    if response.status_code != 200:
-        return {
-            'statusCode': 500,
-            'body': 'Error calling NREL API'
-        }
-    else:
+    def fetch():
+        # Get the response
+        response = checkedRequest(
+            lambda: requests.get(url, timeout=config.EXTERNAL_API_TIMEOUT),
+            'Error calling NREL API')
         data = response.json()
 
-    hsp = data['outputs']['solrad_annual']
-    ac_monthly = data['outputs']['ac_monthly']
-
-
+        try:
+            return {
+                'hsp': data['outputs']['solrad_annual'],
+                'ac_monthly': data['outputs']['ac_monthly'],
+            }
+        except (KeyError, TypeError):
+            raise DataError("Unexpected NREL response")
+
+    key = (lat, lon, array['capacity'], array['tilt'], array['azimuth'], array['losses'])
+    return fetchSiteData(production_source, key, fetch, 'Error calling NREL API')
+
+def productionStage(lat, lon, arrays):
+    # Fetch the production of the sub-arrays concurrently
+    array_results = list(production_executor.map(lambda array: arrayProduction(lat, lon, array), arrays))
+
+    monthly = np.array([production['ac_monthly'] for production, _ in array_results])
+    solrad = np.array([production['hsp'] for production, _ in array_results])
+    capacities = np.array([array['capacity'] for array in arrays])
+
+    production = {
+        # Solar radiation of the system, weighted by the capacity of each array
+        'hsp': float(np.average(solrad, weights=capacities)),
+        'ac_monthly': monthly.sum(axis=0).tolist(),
+        'arrays': [
+            dict(array, ac_annual=float(ac_annual))
+            for array, ac_annual in zip(arrays, monthly.sum(axis=1))
+        ],
+    }
+    stale = any(array_stale for _, array_stale in array_results)
+    return StaleResult(production) if stale else production
+
+def orientationStage(lat, arrays):
+    # Suggest the best orientation of each roof face, the sun samples are shared by all faces
+    sun = sunPositionSamples(lat)
+    return [
+        suggestOrientation(lat, array['tilt'], array['azimuth'], sun=sun)
+        for array in arrays
+    ]
+
+def productionChartStage(production, conversationId):
     # Create the production image
-    prod_img = os.path.join(config.TEMP_DIR, 'monthly_production.png')
-    createProductionImage(ac_monthly, prod_img)
+    prod_img = reportTempPath(conversationId, 'monthly_production.png')
+    createProductionImage(production['ac_monthly'], prod_img)
+    return prod_img
 
+def financialsStage(production, system_capacity, avgDailyConsumption, panelsCapacity, costPerKwh):
     # Calculate the anual production and consumption
-    anual_production =  math.floor(sum(ac_monthly))
-    yearlyKWhEnergyConsumption = math.ceil(avg_daily_consumption * 365)
+    anual_production =  math.floor(sum(production['ac_monthly']))
+    yearlyKWhEnergyConsumption = math.ceil(avgDailyConsumption * 365)
 
     # percentage of annual saves
     savings_percentage = round(anual_production / yearlyKWhEnergyConsumption * 100, 1)
-    n_panels = int(system_capacity//(panels_capacity/1000))
-    req_area = math.ceil(n_panels * config.PANELS_AREA[panels_capacity])
+    n_panels = int(system_capacity//(panelsCapacity/1000))
+    req_area = math.ceil(n_panels * config.PANELS_AREA[panelsCapacity])
     avgCostPerKw = config.AVG_INSTALLED_COST_PER_KW
 
     # Financials
@@ -140,61 +346,110 @@ def lambda_handler(event, context):
     totalCostWithSolar = installationCost + sum(billWithSolar) - config.INCENTIVES
     costOfElectricityWithoutSolar = sum(billWithoutSolar)
 
-    savings = costOfElectricityWithoutSolar - totalCostWithSolar
+    return {
+        'anual_production': anual_production,
+        'yearlyKWhEnergyConsumption': yearlyKWhEnergyConsumption,
+        'savings_percentage': savings_percentage,
+        'n_panels': n_panels,
+        'req_area': req_area,
+        'installationCost': installationCost,
+        'billWithSolar': billWithSolar,
+        'billWithoutSolar': billWithoutSolar,
+        'totalCostWithSolar': totalCostWithSolar,
+        'costOfElectricityWithoutSolar': costOfElectricityWithoutSolar,
+        'savings': costOfElectricityWithoutSolar - totalCostWithSolar,
+        'savingsFirstYear': billWithoutSolar[0] - billWithSolar[0],
+    }
 
-    savingsFirstYear = billWithoutSolar[0] - billWithSolar[0]
+def utilityBillChartStage(financials, conversationId):
+    # Create the utility bill chart, the chart modifies the bills so it gets a copy
+    utility_bill_img = reportTempPath(conversationId, 'utility_bill_chart.png')
+    createUtilityBillChart(
+        financials['installationCost'],
+        list(financials['billWithSolar']),
+        list(financials['billWithoutSolar']),
+        utility_bill_img)
+    return utility_bill_img
+
+def optimizeImageStage(source, template_key, dpi=config.REPORT_IMAGE_DPI, suffix='optimized'):
+    """
+    Returns a stage function that right-sizes and compresses the image of the source stage
+    for the given template placeholder.
+    """
+    def stage(conversationId, **inputs):
+        output_path = reportTempPath(conversationId, f"{template_key}_{suffix}.png")
+        return optimizeImage(inputs[source], output_path, REPORT_IMAGE_WIDTHS[template_key], dpi=dpi)
+    return stage
 
-    # Create the utility bill chart
-    utility_bill_img = os.path.join(config.TEMP_DIR, 'utility_bill_chart.png')
-    createUtilityBillChart(installationCost, billWithSolar, billWithoutSolar, utility_bill_img)
+def inlineImage(image):
+    """
+    Returns an optimized image as a base64 data URI.
+    """
+    with open(image['path'], 'rb') as f:
+        return 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
 
-    # Fill the word template
-    # Define paths and context
-    template_path = 'wattsonReportTemplate.docx'
-    output_path = os.path.join(config.TEMP_DIR, 'prodReport.docx')
-    template_context = {
+def templateContextStage(locationInfo, production, financials, system_capacity, arrays):
+    return {
         'nombreProyecto': 'Produccion de energia solar',
-        'dirProyecto': address,
+        'dirProyecto': locationInfo['address'],
         'potenciaInstalada': system_capacity,
-        'nPaneles': n_panels,
-        'horasSolaresPico': round(hsp, 2),
-        'perdidas':20,
-        'inclinacion': tilt,
-        'orientacion': 180,
-        'prodAnual': anual_production,
-        'consumoAnual': yearlyKWhEnergyConsumption,
-        'PorcAhorroAnual': savings_percentage,
-        'areaRequerida': req_area,
+        'nPaneles': financials['n_panels'],
+        'horasSolaresPico': round(production['hsp'], 2),
+        'perdidas': formatArraysValue(arrays, 'losses'),
+        'inclinacion': formatArraysValue(arrays, 'tilt'),
+        'orientacion': formatArraysValue(arrays, 'azimuth'),
+        'prodAnual': financials['anual_production'],
+        'consumoAnual': financials['yearlyKWhEnergyConsumption'],
+        'PorcAhorroAnual': financials['savings_percentage'],
+        'areaRequerida': financials['req_area'],
         'tiempoVidaPy': config.INSTALLATION_LIFE_SPAN,
-        'ahorroMensual': formatNumberToCurrency(savingsFirstYear/12),
-        'ahorroAnual': formatNumberToCurrency(savingsFirstYear),
-        'costoInstalacion': formatNumberToCurrency(installationCost),
-        'CostoSinPaneles': formatNumberToCurrency(costOfElectricityWithoutSolar),
-        'CostoConPaneles': formatNumberToCurrency(totalCostWithSolar),
-        'ahorroTotal': formatNumberToCurrency(savings),
+        'ahorroMensual': formatNumberToCurrency(financials['savingsFirstYear']/12),
+        'ahorroAnual': formatNumberToCurrency(financials['savingsFirstYear']),
+        'costoInstalacion': formatNumberToCurrency(financials['installationCost']),
+        'CostoSinPaneles': formatNumberToCurrency(financials['costOfElectricityWithoutSolar']),
+        'CostoConPaneles': formatNumberToCurrency(financials['totalCostWithSolar']),
+        'ahorroTotal': formatNumberToCurrency(financials['savings']),
     }
 
+def reportStage(templateContext, optimizedLocationImage, optimizedProductionChart, optimizedUtilityBillChart, userId, conversationId):
+    # Fill the word template
+    # Define paths and context
+    template_path = 'wattsonReportTemplate.docx'
+    # The report is not memoized, so every conversation shares the same file
+    output_path = os.path.join(config.TEMP_DIR, 'prodReport.docx')
+
+    images = {
+        'imglUbicacion': optimizedLocationImage,
+        'imglProduccion': optimizedProductionChart,
+        'imglFlujoCostos': optimizedUtilityBillChart,
+    }
     img_context = {
-        'imglUbicacion': {'path': location_img, 'width': 45},
-        'imglProduccion': {'path': prod_img, 'width': 130},
-        'imglFlujoCostos': {'path': utility_bill_img, 'width': 130}
+        key: {'path': image['path'], 'width': REPORT_IMAGE_WIDTHS[key]}
+        for key, image in images.items()
     }
 
-    fill_word_template(template_path, output_path, template_context, img_context)
+    # The template adds the images to the context, so it gets a copy
+    fill_word_template(template_path, output_path, dict(templateContext), img_context)
+
+    # Byte sizes of the artifacts, to track the document size and transfer time
+    artifact_sizes = {
+        key: {'original': image['original_bytes'], 'optimized': image['bytes']}
+        for key, image in images.items()
+    }
+    artifact_sizes['docx'] = os.path.getsize(output_path)
+    logger.info(f"Artifact sizes: {artifact_sizes}")
 
     # Save report to S3
     logger.info(f"Saving report to S3")
     bucket = os.environ['UploadBucket']
     try:                            
         docx_key = getReportKey(userId, conversationId, 'docx')
-        docx_url = saveDocxInS3(open(output_path, 'rb'), bucket, docx_key)
+        with open(output_path, 'rb') as docx_file:
+            docx_url = saveDocxInS3(docx_file, bucket, docx_key)
         docx_signed_url = getGetterSignedUrl(bucket, docx_key)
     except Exception as e:
         logger.error(f"Error saving report to S3: {e}")
-        return {
-            'statusCode': 500,
-            'body': 'Error saving report to S3'
-        }
+        raise PipelineError('Error saving report to S3')
 
     # Convert the docx to pdf
     logger.info(f"Converting docx to pdf")
@@ -211,13 +466,158 @@ def lambda_handler(event, context):
         
     except Exception as e:
         logger.error(f"Error converting docx to pdf: {e}")
+        raise PipelineError('Error converting docx to pdf')
+
+    return {'pdfUrl': output_url, 'artifactSizes': artifact_sizes}
+
+# The report pipeline, each stage is only run again when one of its inputs changes.
+# The report itself is always rendered, uploaded and converted again.
+report_pipeline = Pipeline([
+    Stage('locationImage', locationImageStage, ['lat', 'lon', 'conversationId']),
+    Stage('locationInfo', locationInfoStage, ['lat', 'lon']),
+    Stage('production', productionStage, ['lat', 'lon', 'arrays']),
+    Stage('orientation', orientationStage, ['lat', 'arrays']),
+    Stage('productionChart', productionChartStage, ['production', 'conversationId']),
+    Stage('financials', financialsStage, ['production', 'system_capacity', 'avgDailyConsumption', 'panelsCapacity', 'costPerKwh']),
+    Stage('utilityBillChart', utilityBillChartStage, ['financials', 'conversationId']),
+    Stage('optimizedLocationImage', optimizeImageStage('locationImage', 'imglUbicacion'), ['locationImage', 'conversationId']),
+    Stage('optimizedProductionChart', optimizeImageStage('productionChart', 'imglProduccion'), ['productionChart', 'conversationId']),
+    Stage('optimizedUtilityBillChart', optimizeImageStage('utilityBillChart', 'imglFlujoCostos'), ['utilityBillChart', 'conversationId']),
+    Stage('compactProductionChart', optimizeImageStage('productionChart', 'imglProduccion', dpi=config.SUMMARY_IMAGE_DPI, suffix='compact'), ['productionChart', 'conversationId']),
+    Stage('compactUtilityBillChart', optimizeImageStage('utilityBillChart', 'imglFlujoCostos', dpi=config.SUMMARY_IMAGE_DPI, suffix='compact'), ['utilityBillChart', 'conversationId']),
+    Stage('templateContext', templateContextStage, ['locationInfo', 'production', 'financials', 'system_capacity', 'arrays']),
+    Stage('report', reportStage, ['templateContext', 'optimizedLocationImage', 'optimizedProductionChart', 'optimizedUtilityBillChart', 'userId', 'conversationId'], memoize=False),
+], max_conversations=config.PIPELINE_MAX_CONVERSATIONS, on_evict=removeConversationFiles)
+
+# Stages run for each format of the response
+FORMAT_TARGETS = {
+    'pdf': ['report', 'orientation'],
+    'summary': ['templateContext', 'orientation'],
+}
+SUMMARY_CHART_TARGETS = ['compactProductionChart', 'compactUtilityBillChart']
+
+def lambda_handler(event, context):
+    """
+    Lambda function handler for generating a production report.
+
+    The report is computed as a pipeline of stages memoized per conversation, so a
+    follow up request of the same conversation only recomputes the stages whose inputs changed.
+    The system can be split in several sub-arrays with the optional `arrays` query parameter,
+    see parseArrays.
+
+    With `format=summary` only the values of the report are computed and returned as JSON,
+    with `charts=inline` the charts are included as compact base64 images. The PDF can be
+    requested later in the same conversation, reusing the already computed stages.
+    Missing or invalid query parameters return a 400 with the reason.
+
+    Args:
+        event (dict): The event data passed to the Lambda function.
+        context (object): The runtime information of the Lambda function.
+
+    Returns:
+        dict: The response containing the PDF URL of the generated report and the byte sizes of its
+        artifacts (or the report values and charts for the summary format), the suggested orientation of each sub-array,
+        the reused stages, the stages served from cached data while an external source was unavailable
+        and, when MEMORY_PROFILING is enabled, the memory usage of the invocation.
+
+    Raises:
+        ValueError: If the response from the NREL API is not in the expected format.
+        IOError: If there is an error saving or reading the location image or production image.
+        RuntimeError: If there is an error filling the word template.
+
+    """
+
+    # Get query parameters
+    query_params = event['queryStringParameters'] or {}
+    report_format = query_params.get('format', 'pdf')
+    inline_charts = query_params.get('charts') == 'inline'
+    if report_format not in FORMAT_TARGETS:
         return {
-            'statusCode': 500,
-            'body': 'Error converting docx to pdf'
+            'statusCode': 400,
+            'body': f"Invalid format: {report_format}"
         }
 
-    # Return the signed url
+    try:
+        for name in ('userId', 'conversationId'):
+            if not query_params.get(name):
+                raise ValueError(f"Missing {name}")
+        lat = parseNumber(query_params, 'lat', minimum=-90, maximum=90)
+        lon = parseNumber(query_params, 'lon', minimum=-180, maximum=180)
+        # The system capacity is only needed when the system is not split in sub-arrays
+        system_capacity = parseNumber(query_params, 'system_capacity', positive=True, required=not query_params.get('arrays'))
+        avg_daily_consumption = parseNumber(query_params, 'avgDailyConsumption', positive=True)
+        panels_capacity = parseNumber(query_params, 'panelsCapacity', positive=True)
+        if panels_capacity not in config.PANELS_AREA:
+            raise ValueError(f"Invalid panelsCapacity: must be one of {list(config.PANELS_AREA)}")
+        cost_per_kwh = parseNumber(query_params, 'costPerKwh', minimum=0)
+        arrays = parseArrays(query_params, lat, system_capacity)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+
+    params = {
+        'lat': lat,
+        'lon': lon,
+        # With several sub-arrays the system capacity is their total capacity
+        'system_capacity': sum(array['capacity'] for array in arrays),
+        'arrays': arrays,
+        'avgDailyConsumption': avg_daily_consumption,
+        'panelsCapacity': panels_capacity,
+        'userId': query_params['userId'],
+        'conversationId': query_params['conversationId'],
+        'costPerKwh': cost_per_kwh,
+    }
+
+    targets = list(FORMAT_TARGETS[report_format])
+    if report_format == 'summary' and inline_charts:
+        targets += SUMMARY_CHART_TARGETS
+
+    if memory_profiler:
+        memory_profiler.startInvocation()
+    try:
+        results, reused, stale = report_pipeline.run(
+            params['conversationId'],
+            params,
+            targets=targets,
+            stage_context=memory_profiler.stage if memory_profiler else None)
+    except PipelineError as e:
+        return {
+            'statusCode': 500,
+            'body': str(e)
+        }
+    finally:
+        memory = memory_profiler.endInvocation() if memory_profiler else None
+
+    if reused:
+        logger.info(f"Reused stages: {reused}")
+    if stale:
+        logger.warning(f"Report generated with cached data for stages: {stale}")
+
+    if report_format == 'summary':
+        body = {'summary': results['templateContext']}
+        if inline_charts:
+            body['charts'] = {
+                'imglProduccion': inlineImage(results['compactProductionChart']),
+                'imglFlujoCostos': inlineImage(results['compactUtilityBillChart']),
+            }
+    else:
+        body = {
+            'pdfUrl': results['report']['pdfUrl'],
+            'artifactSizes': results['report']['artifactSizes'],
+        }
+    body.update({
+        'orientationSuggestions': results['orientation'],
+        'reusedStages': reused,
+        'usingCachedData': bool(stale),
+        'cachedStages': stale
+    })
+    if memory:
+        body['memory'] = memory
+
+    # Return the signed url or the summary
     return {
         'statusCode': 200,
-        'body': json.dumps({'pdfUrl': output_url})
+        'body': json.dumps(body)
     }
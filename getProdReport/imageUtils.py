@@ -0,0 +1,56 @@
+import os
+import logging
+from PIL import Image
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MM_PER_INCH = 25.4
+
+def optimizeImage(input_path, output_path, width_mm, dpi=150, colors=256):
+    """
+    Prepares an image to be embedded in the report.
+
+    The image is downscaled to the pixels needed to print it at the given width and dpi,
+    quantized to a palette and saved as an optimized PNG without metadata.
+
+    Args:
+        input_path (str): The path of the image to optimize.
+        output_path (str): The path where the optimized image is saved.
+        width_mm (float): The width of the image in the report in millimeters.
+        dpi (int, optional): The resolution of the image in the report. Defaults to 150.
+        colors (int, optional): The number of colors of the palette. Defaults to 256.
+
+    Returns:
+        dict: The path of the optimized image and the byte sizes before and after the optimization.
+    """
+    with Image.open(input_path) as img:
+        img.load()
+        # Flatten the alpha channel, the report background is white
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+
+    width_px = round(width_mm / MM_PER_INCH * dpi)
+    if img.width > width_px:
+        height_px = max(1, round(img.height * width_px / img.width))
+        img = img.resize((width_px, height_px), Image.LANCZOS)
+
+    img = img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+    # Drop the metadata (text chunks, icc profile, etc.)
+    img.info = {}
+    img.save(output_path, format='PNG', optimize=True)
+
+    original_bytes = os.path.getsize(input_path)
+    optimized_bytes = os.path.getsize(output_path)
+    logger.info(f"Image {input_path} optimized from {original_bytes} to {optimized_bytes} bytes")
+    return {
+        'path': output_path,
+        'original_bytes': original_bytes,
+        'bytes': optimized_bytes,
+    }
@@ -0,0 +1,126 @@
+"""
+Opt-in memory instrumentation of the report pipeline.
+
+Records the peak and retained memory of each stage (tracemalloc) and of each invocation
+(tracemalloc and RSS), and flags the growth of a warm container across consecutive invocations.
+Enable it with the MEMORY_PROFILING environment variable, tracemalloc slows down the function.
+
+Author: Amoreno
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import os
+import resource
+import tracemalloc
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def currentRss():
+    """
+    Returns the resident set size of the process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Not on Linux, fall back to the peak RSS
+        return peakRss()
+
+def peakRss():
+    """
+    Returns the peak resident set size of the process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryProfiler:
+    """
+    Collects the memory usage of the stages of an invocation and of consecutive invocations.
+
+    Args:
+        growth_window (int, optional): Consecutive invocations checked for growth. Defaults to 5.
+        growth_threshold (int, optional): Bytes the RSS must grow over the window to be flagged.
+            Defaults to 5 MB.
+    """
+
+    def __init__(self, growth_window=5, growth_threshold=5 * 1024 * 1024):
+        self.growth_window = growth_window
+        self.growth_threshold = growth_threshold
+        self.history = deque(maxlen=growth_window)
+        self.invocations = 0
+        self._stages = []
+        self._traced_start = 0
+        self._traced_peak = 0
+        self._rss_start = 0
+
+    def startInvocation(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._stages = []
+        tracemalloc.reset_peak()
+        self._traced_start = tracemalloc.get_traced_memory()[0]
+        self._traced_peak = self._traced_start
+        self._rss_start = currentRss()
+
+    def _updatePeak(self):
+        """
+        Keeps the absolute traced peak of the invocation, including what earlier stages
+        retained and the allocations made outside the stages.
+        """
+        self._traced_peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager recording the memory used by a stage.
+        """
+        self._updatePeak()
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            self._traced_peak = max(self._traced_peak, traced_peak)
+            self._stages.append({
+                'stage': name,
+                'peakBytes': traced_peak - traced_before,
+                'retainedBytes': traced_after - traced_before,
+                'rssBytes': currentRss(),
+            })
+
+    def endInvocation(self):
+        """
+        Returns the memory summary of the invocation and checks the growth across invocations.
+        """
+        self.invocations += 1
+        self._updatePeak()
+        rss = currentRss()
+        self.history.append(rss)
+
+        growth = self.history[-1] - self.history[0]
+        growing = (
+            len(self.history) == self.growth_window and
+            all(b >= a for a, b in zip(self.history, list(self.history)[1:])) and
+            growth > self.growth_threshold)
+        if growing:
+            logger.warning(f"RSS grew {growth} bytes over the last {self.growth_window} invocations")
+
+        summary = {
+            'invocation': self.invocations,
+            'peakBytes': self._traced_peak - self._traced_start,
+            'retainedBytes': tracemalloc.get_traced_memory()[0] - self._traced_start,
+            'rssStartBytes': self._rss_start,
+            'rssBytes': rss,
+            'peakRssBytes': peakRss(),
+            'rssGrowthBytes': growth,
+            'growthDetected': growing,
+            'stages': self._stages,
+        }
+        logger.info(f"Memory usage: {summary}")
+        return summary
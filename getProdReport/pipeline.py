@@ -0,0 +1,167 @@
+"""
+Stage based execution of the production report.
+
+Each stage declares the request parameters and the other stages it depends on.
+Results are memoized per conversation, so when a user only tweaks some of the
+inputs (e.g. the cost per kWh) only the stages that depend on them are run again.
+
+Author: Amoreno
+"""
+
+from collections import OrderedDict
+from contextlib import nullcontext
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class PipelineError(Exception):
+    """
+    Raised by a stage when the report can not be generated.
+    The message is returned as the body of the error response.
+    """
+
+
+class StaleResult:
+    """
+    Wraps a result a stage could only get from a stale cache.
+    Stale results are used for the current run but never memoized, and they
+    discard the result previously memoized for the stage.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Stage:
+    """
+    A step of the report pipeline.
+
+    Args:
+        name (str): The name of the stage, used by other stages to depend on its result.
+        func (callable): The function computing the stage. It is called with one keyword
+            argument per input.
+        inputs (list): The names of the request parameters and stages the function needs.
+        memoize (bool, optional): Whether the result can be reused while the inputs do not change.
+            Defaults to True.
+    """
+
+    def __init__(self, name, func, inputs, memoize=True):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.memoize = memoize
+
+
+class Pipeline:
+    """
+    Runs a list of stages, reusing the memoized results of the stages whose inputs did not change.
+
+    Args:
+        stages (list): The stages, declared after the stages they depend on.
+        max_conversations (int, optional): The number of conversations kept in memory. Defaults to 50.
+        on_evict (callable, optional): Called with the id of a conversation evicted from memory,
+            e.g. to delete the files of its memoized results.
+    """
+
+    def __init__(self, stages, max_conversations=50, on_evict=None):
+        self.stages = OrderedDict()
+        for stage in stages:
+            self.stages[stage.name] = stage
+        self.max_conversations = max_conversations
+        self.on_evict = on_evict
+        self._memo = OrderedDict()
+
+    def _conversationMemo(self, conversation_id):
+        memo = self._memo.setdefault(conversation_id, {})
+        self._memo.move_to_end(conversation_id)
+        while len(self._memo) > self.max_conversations:
+            evicted_id, _ = self._memo.popitem(last=False)
+            logger.info(f"Evicting conversation {evicted_id}")
+            if self.on_evict:
+                self.on_evict(evicted_id)
+        return memo
+
+    def _plan(self, targets):
+        """
+        Returns the names of the stages needed to compute the targets, in execution order.
+        """
+        if targets is None:
+            return list(self.stages)
+
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            pending.extend(i for i in self.stages[name].inputs if i in self.stages)
+        return [name for name in self.stages if name in needed]
+
+    def run(self, conversation_id, params, targets=None, stage_context=None):
+        """
+        Runs the pipeline for a conversation.
+
+        Args:
+            conversation_id (str): The conversation the results are memoized for.
+            params (dict): The request parameters.
+            targets (list, optional): The stages to compute. Defaults to all the stages.
+            stage_context (callable, optional): Called with the name of each stage that is run,
+                returns a context manager wrapping the stage (e.g. to profile it).
+
+        Returns:
+            tuple: The results by stage name, the list of stages that were reused and
+            the list of stages that returned stale results.
+
+        Raises:
+            PipelineError: If a stage can not be computed.
+        """
+        memo = self._conversationMemo(conversation_id)
+        results = {}
+        keys = {}
+        reused = []
+        stale = []
+
+        for name in self._plan(targets):
+            stage = self.stages[name]
+            kwargs = {}
+            key = []
+            for input_name in stage.inputs:
+                if input_name in self.stages:
+                    kwargs[input_name] = results[input_name]
+                    key.append(keys[input_name])
+                else:
+                    kwargs[input_name] = params[input_name]
+                    key.append(params[input_name])
+            key = tuple(key)
+
+            cached = memo.get(name)
+            if stage.memoize and cached is not None and cached[0] == key:
+                results[name] = cached[1]
+                keys[name] = (name, key)
+                reused.append(name)
+                continue
+
+            logger.info(f"Running stage {name}")
+            with stage_context(name) if stage_context else nullcontext():
+                result = stage.func(**kwargs)
+            if isinstance(result, StaleResult):
+                results[name] = result.value
+                keys[name] = object()
+                stale.append(name)
+                # The stale result may overwrite the files of the memoized one, e.g. the
+                # location image of another site, so the memoized result can not be reused
+                memo.pop(name, None)
+            elif stage.memoize:
+                results[name] = result
+                memo[name] = (key, results[name])
+                keys[name] = (name, key)
+            else:
+                # Results of non memoized stages are never considered equal
+                results[name] = result
+                keys[name] = object()
+
+        return results, reused, stale
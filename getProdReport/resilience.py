@@ -0,0 +1,227 @@
+"""
+Circuit breakers and stale-while-revalidate caching for the external data sources (Google, NREL).
+
+When a source errors or slows down, its breaker opens and the requests fail fast. While the
+breaker is open, or a refresh is in flight, the most recent data of the site is served from
+the cache and refreshed in the background. Data younger than the freshness window of the
+source is served from the cache without calling the dependency.
+
+Note: Lambda freezes the container once the handler returns, so a background refresh
+finishes during the next invocation of the same warm container.
+
+Author: Amoreno
+"""
+
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call is rejected because the circuit breaker is open.
+    """
+
+
+class DataError(Exception):
+    """
+    Raised by a call for errors of the request or of the returned data (e.g. a 4xx response
+    or an empty result), which say nothing about the health of the dependency.
+    It does not count as a failure of the breaker.
+    """
+
+
+class CircuitBreaker:
+    """
+    Tracks the errors and latency of an external dependency.
+
+    The breaker opens after `failure_threshold` consecutive failures, a call that raises (except
+    DataError) or takes longer than `latency_threshold` seconds counts as a failure. Once `reset_timeout`
+    seconds have passed a single trial call is allowed, if it succeeds the breaker closes again.
+    Calls made while the trial is in flight wait for its outcome instead of failing, so concurrent
+    requests (e.g. the sub-arrays of a report) are not rejected right after the dependency recovers.
+
+    Args:
+        name (str): The name of the dependency, used in the logs.
+        failure_threshold (int, optional): Consecutive failures that open the breaker. Defaults to 3.
+        latency_threshold (float, optional): Seconds after which a call counts as a failure. Defaults to 5.
+        reset_timeout (float, optional): Seconds the breaker stays open before a trial call. Defaults to 30.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=3, latency_threshold=5.0, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Condition()
+
+    def isClosed(self):
+        return self.state == self.CLOSED
+
+    def canTry(self):
+        """
+        Returns whether a call would be allowed, without reserving the trial call.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+        return False
+
+    def _allowRequest(self):
+        with self._lock:
+            # Wait for the trial call, it closes or opens the breaker again
+            self._lock.wait_for(lambda: self.state != self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                logger.info(f"Circuit {self.name} half open, trying a call")
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def _recordSuccess(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit {self.name} closed")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._lock.notify_all()
+
+    def _recordFailure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit {self.name} open after {self._failures} failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._lock.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls the function through the breaker.
+
+        Raises:
+            CircuitOpenError: If the breaker is open.
+            Exception: Any exception raised by the function.
+        """
+        if not self._allowRequest():
+            raise CircuitOpenError(f"Circuit {self.name} is open")
+
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except DataError:
+            # The dependency answered, the error is in the request or its data
+            self._recordSuccess()
+            raise
+        except BaseException:
+            # Any interruption of a trial call must release the waiting calls
+            self._recordFailure()
+            raise
+
+        elapsed = time.monotonic() - start
+        if elapsed > self.latency_threshold:
+            logger.warning(f"Slow call to {self.name}: {elapsed:.2f}s")
+            self._recordFailure()
+        else:
+            self._recordSuccess()
+        return result
+
+
+class StaleWhileRevalidate:
+    """
+    Cache of the last data fetched for each site from a dependency guarded by a circuit breaker.
+
+    Args:
+        breaker (CircuitBreaker): The breaker of the dependency.
+        max_entries (int, optional): The number of sites kept in the cache. Defaults to 200.
+        fresh_for (float, optional): Seconds the cached data is served without fetching it again.
+            Defaults to 0 (always fetch when the breaker is closed).
+    """
+
+    def __init__(self, breaker, max_entries=200, fresh_for=0):
+        self.breaker = breaker
+        self.max_entries = max_entries
+        self.fresh_for = fresh_for
+        self._cache = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _store(self, key, value):
+        with self._lock:
+            self._cache[key] = (value, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _refresh(self, key, fetch):
+        try:
+            self._store(key, self.breaker.call(fetch))
+            logger.info(f"Background refresh of {key} done")
+        except Exception as e:
+            logger.warning(f"Background refresh of {key} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refreshInBackground(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing or not self.breaker.canTry():
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+
+    def get(self, key, fetch):
+        """
+        Returns the data of the site, fetching it through the breaker when possible.
+
+        Args:
+            key (hashable): The key of the site.
+            fetch (callable): Function fetching the data, it must raise on errors.
+
+        Returns:
+            tuple: The data and whether it is stale, i.e. served from the cache because the
+            dependency is unavailable or being refreshed.
+
+        Raises:
+            CircuitOpenError: If the breaker is open and there is no cached data.
+            Exception: Any exception raised by fetch when there is no cached data.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            refreshing = key in self._refreshing
+
+        cached = None
+        if entry is not None:
+            cached, stored_at = entry
+            if time.monotonic() - stored_at < self.fresh_for:
+                return cached, False
+
+        if cached is not None and (refreshing or not self.breaker.isClosed()):
+            self._refreshInBackground(key, fetch)
+            return cached, True
+
+        try:
+            value = self.breaker.call(fetch)
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.warning(f"Serving cached data for {key}: {e}")
+            return cached, True
+
+        self._store(key, value)
+        return value, False
@@ -21,7 +21,7 @@ month_names = {
     12: 'Dic'
 }
 
-def getLocationImage(lat, lon, google_api_key):
+def getLocationImage(lat, lon, google_api_key, timeout=None, raise_errors=False):
     """
     Retrieves a static map image for a given location using the Google Maps API.
 
@@ -29,6 +29,8 @@ def getLocationImage(lat, lon, google_api_key):
         lat (float): Latitude of the location.
         lon (float): Longitude of the location.
         google_api_key (str): API key for accessing the Google Maps API.
+        timeout (float, optional): Seconds to wait for the API. Defaults to None (wait forever).
+        raise_errors (bool, optional): Raise request errors instead of returning None. Defaults to False.
 
     Returns:
         requests.Response: The response object containing the static map image.
@@ -43,14 +45,16 @@ def getLocationImage(lat, lon, google_api_key):
         url += "&maptype=roadmap"
         url += f"&markers=color:red%7C{lat},{lon}"
         url += f"&key={google_api_key}"
-        response = requests.get(url)
+        response = requests.get(url, timeout=timeout)
         response.raise_for_status()  # Raise an exception for non-successful status codes
         return response
     except requests.exceptions.RequestException as e:
+        if raise_errors:
+            raise
         print(f"An error occurred: {e}")
         return None
 
-def getLocationInfo(lat, lon, google_api_key):
+def getLocationInfo(lat, lon, google_api_key, timeout=None, raise_errors=False):
     """
     Retrieves location information based on latitude and longitude using the Google Geocoding API.
 
@@ -58,6 +62,8 @@ def getLocationInfo(lat, lon, google_api_key):
         lat (float): The latitude of the location.
         lon (float): The longitude of the location.
         google_api_key (str): The API key for accessing the Google Geocoding API.
+        timeout (float, optional): Seconds to wait for the API. Defaults to None (wait forever).
+        raise_errors (bool, optional): Raise request errors instead of returning None. Defaults to False.
 
     Returns:
         requests.Response or None: The response object containing the location information if successful,
@@ -65,10 +71,12 @@ def getLocationInfo(lat, lon, google_api_key):
     """
     try:
         url = f"https://maps.googleapis.com/maps/api/geocode/json?latlng={lat},{lon}&key={google_api_key}"
-        response = requests.get(url)
+        response = requests.get(url, timeout=timeout)
         response.raise_for_status()  # Raise an exception for non-successful status codes
         return response
     except requests.exceptions.RequestException as e:
+        if raise_errors:
+            raise
         print(f"An error occurred: {e}")
         return None
 
@@ -122,6 +130,89 @@ def getProduction(api_key, lat, lon, system_capacity, azimut=180, tilt=0, losses
         print(f"An error occurred: {e}")
         return None
 
+def sunPositionSamples(lat, step_hours=0.25):
+    """
+    Samples the sun position over a representative day of each month.
+
+    Args:
+        lat (float): The latitude in degrees.
+        step_hours (float, optional): The time between samples in hours. Defaults to 0.25.
+
+    Returns:
+        dict: The east, north and up components of the sun direction and the clear sky
+        direct normal irradiance (W/m2) of the daylight samples, as numpy arrays.
+    """
+    phi = np.radians(float(lat))
+    # Day of the year of the 15th of each month
+    days = np.array([15, 46, 74, 105, 135, 166, 196, 227, 258, 288, 319, 349])
+    hours = np.arange(0, 24, step_hours)
+    declination = np.radians(23.45 * np.sin(np.radians(360 / 365 * (284 + days))))[:, None]
+    hour_angle = np.radians(15 * (hours - 12))[None, :]
+
+    up = np.sin(phi) * np.sin(declination) + np.cos(phi) * np.cos(declination) * np.cos(hour_angle)
+    east = -np.cos(declination) * np.sin(hour_angle)
+    north = np.cos(phi) * np.sin(declination) - np.sin(phi) * np.cos(declination) * np.cos(hour_angle)
+
+    daylight = up > 0.01
+    up, east, north = up[daylight], east[daylight], north[daylight]
+    # Clear sky direct irradiance attenuated by the air mass
+    dni = 1353 * np.power(0.7, np.power(1 / up, 0.678))
+    return {'east': east, 'north': north, 'up': up, 'dni': dni}
+
+def relativePlaneIrradiance(sun, tilt, azimuth):
+    """
+    Estimates the relative yearly clear sky irradiance on tilted planes.
+
+    Args:
+        sun (dict): The sun samples returned by sunPositionSamples.
+        tilt (array-like): The tilt angles in degrees.
+        azimuth (array-like): The azimuth angles in degrees (180 = south), broadcastable with tilt.
+
+    Returns:
+        numpy.ndarray: The irradiance of each plane, with the broadcast shape of tilt and azimuth.
+    """
+    beta = np.radians(np.asarray(tilt, dtype=float))[..., None]
+    gamma = np.radians(np.asarray(azimuth, dtype=float))[..., None]
+    cos_incidence = (
+        np.sin(beta) * np.sin(gamma) * sun['east'] +
+        np.sin(beta) * np.cos(gamma) * sun['north'] +
+        np.cos(beta) * sun['up'])
+    beam = sun['dni'] * np.clip(cos_incidence, 0, None)
+    # Isotropic sky diffuse irradiance
+    diffuse = 0.1 * sun['dni'] * (1 + np.cos(beta)) / 2
+    return (beam + diffuse).sum(axis=-1)
+
+def suggestOrientation(lat, tilt, azimuth, azimuth_range=45, max_tilt=60, sun=None):
+    """
+    Searches the tilt and azimuth with the highest yearly irradiance for a roof face.
+
+    The search evaluates a grid of tilts and of azimuths around the azimuth of the face
+    with a clear sky model, so it is fast enough to run on every report.
+
+    Args:
+        lat (float): The latitude in degrees.
+        tilt (float): The current tilt of the array in degrees.
+        azimuth (float): The azimuth of the roof face in degrees.
+        azimuth_range (float, optional): Degrees the azimuth can deviate from the face. Defaults to 45.
+        max_tilt (float, optional): The maximum tilt searched. Defaults to 60.
+        sun (dict, optional): The sun samples of the latitude, computed if not given.
+
+    Returns:
+        dict: The suggested tilt and azimuth and the expected gain over the current orientation.
+    """
+    if sun is None:
+        sun = sunPositionSamples(lat)
+    tilts = np.arange(0, max_tilt + 1, 1.0)
+    azimuths = np.arange(azimuth - azimuth_range, azimuth + azimuth_range + 1, 5.0) % 360
+    irradiance = relativePlaneIrradiance(sun, tilts[:, None], azimuths[None, :])
+    best_tilt, best_azimuth = np.unravel_index(np.argmax(irradiance), irradiance.shape)
+    current = relativePlaneIrradiance(sun, tilt, azimuth)
+    return {
+        'tilt': float(tilts[best_tilt]),
+        'azimuth': float(azimuths[best_azimuth]),
+        'relativeGain': round(float(irradiance[best_tilt, best_azimuth] / current) - 1, 3),
+    }
+
 def createProductionImage(ac_monthly, output_path):
     # Create a figure and a set of subplots
 
@@ -129,7 +220,7 @@ def createProductionImage(ac_monthly, output_path):
     months = [month_names[i+1] for i in range(12)]
 
     # Plots dc monthly production with seaborn
-    plt.figure(figsize=(10, 5))
+    fig = plt.figure(figsize=(10, 5))
 
     # Create a color map
     min_val = min(ac_monthly)
@@ -154,6 +245,8 @@ def createProductionImage(ac_monthly, output_path):
     plt.xticks(rotation=45)
     plt.tight_layout()  # Adjust the layout to prevent legend cutoff
     plt.savefig(output_path)
+    # Close the figure, pyplot keeps it alive in warm containers otherwise
+    plt.close(fig)
 
 
 ### solar financials
@@ -331,7 +424,7 @@ def createUtilityBillChart(
     billWithSolar[0] = +installationCost
     current_year = datetime.datetime.now().year
     years = range(current_year, current_year + len(billWithSolar))
-    plt.figure(figsize=(10, 5))
+    fig = plt.figure(figsize=(10, 5))
     plt.plot(years, np.cumsum(billWithSolar) / 1000000, marker='o', label='Con paneles solares')
     plt.plot(years, np.cumsum(billWithoutSolar) / 1000000, marker='o', label='Sin paneles solares')
     plt.xlabel('Año')
@@ -343,6 +436,7 @@ def createUtilityBillChart(
     plt.grid(axis='y', linestyle='--', alpha=0.5)  # Add horizontal grids
     plt.tight_layout()  # Adjust the layout to prevent legend cutoff
     plt.savefig(output_path)
+    plt.close(fig)
     return output_path
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+"""
+Soak test of the production report, to size the Lambda memory and detect leaks in warm containers.
+
+Calls the lambda handler repeatedly in the same process, like a warm container does, with memory
+profiling enabled, and prints the memory usage of every invocation. Every other invocation changes
+the cost per kWh, to exercise both the full pipeline and the partial re-rendering.
+
+It calls the real external APIs and S3, so the environment variables of the function
+(API keys and UploadBucket) must be set. It lives outside getProdReport so it is not deployed
+with the function. Run it from the repository root:
+
+    python scripts/soakTest.py --invocations 50
+
+Author: Amoreno
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# The profiling must be enabled before the handler module is loaded
+os.environ['MEMORY_PROFILING'] = '1'
+
+# Load the function like Lambda does, the report template path is relative to its directory
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'getProdReport')
+sys.path.insert(0, FUNCTION_DIR)
+os.chdir(FUNCTION_DIR)
+
+from getProdReport import lambda_handler
+
+
+def buildEvent(args, invocation):
+    return {
+        'queryStringParameters': {
+            'lat': args.lat,
+            'lon': args.lon,
+            'system_capacity': args.system_capacity,
+            'avgDailyConsumption': args.avg_daily_consumption,
+            'panelsCapacity': args.panels_capacity,
+            'costPerKwh': str(float(args.cost_per_kwh) + invocation % 2),
+            'userId': 'soak-test',
+            'conversationId': f"soak-test-{invocation // args.turns_per_conversation}",
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test of the production report')
+    parser.add_argument('--invocations', type=int, default=20)
+    parser.add_argument('--turns-per-conversation', type=int, default=4)
+    parser.add_argument('--lat', default='6.2442')
+    parser.add_argument('--lon', default='-75.5812')
+    parser.add_argument('--system-capacity', default='3')
+    parser.add_argument('--avg-daily-consumption', default='8')
+    parser.add_argument('--panels-capacity', default='400')
+    parser.add_argument('--cost-per-kwh', default='800')
+    args = parser.parse_args()
+
+    growth_detected = False
+    for invocation in range(args.invocations):
+        response = lambda_handler(buildEvent(args, invocation), None)
+        if response['statusCode'] != 200:
+            print(f"Invocation {invocation} failed: {response['body']}")
+            continue
+
+        memory = json.loads(response['body'])['memory']
+        growth_detected = growth_detected or memory['growthDetected']
+        print(
+            f"Invocation {memory['invocation']}: "
+            f"peak {memory['peakBytes'] / 2**20:.1f} MB, "
+            f"retained {memory['retainedBytes'] / 2**20:.1f} MB, "
+            f"RSS {memory['rssBytes'] / 2**20:.1f} MB, "
+            f"peak RSS {memory['peakRssBytes'] / 2**20:.1f} MB")
+        for stage in memory['stages']:
+            print(f"    {stage['stage']}: peak {stage['peakBytes'] / 2**20:.1f} MB, retained {stage['retainedBytes'] / 2**20:.1f} MB")
+
+    print('Memory growth detected' if growth_detected else 'No memory growth detected')
+
+
+if __name__ == "__main__":
+    main()